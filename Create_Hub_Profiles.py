@@ -16,15 +16,98 @@ https://doi.org/10.1016/j.celrep.2023.112521
 """
 __version__ = "0.1.0"
 
-import argparse,datetime,glob,logging,os,subprocess,sys,time
+import argparse,datetime,functools,logging,os,subprocess,sys,time
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
+from scipy import sparse
 import seaborn as sns
 import matplotlib.pyplot as plt
 ## suppress matplotlib font warnings and junk
 mpl_logger = logging.getLogger('matplotlib')
 mpl_logger.setLevel(logging.WARNING)
 
+## Zero indexed Gordon 333 network indices for averaging - loaded once from helper file
+network_names = ['aud','co','cp','dmn','da','fp','none','ret','sal','ssmh','ssmm','va','vis']
+network_indices_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),'Gordon333_Network_Indices.npz')
+with np.load(network_indices_path) as net_npz:
+    networks = [net_npz[name].astype(int) for name in network_names]
+## boolean network membership masks (13 x 333)
+net_masks = np.zeros((len(networks),333), dtype=bool)
+for k,net in enumerate(networks):
+    net_masks[k,net] = True
+if np.all(net_masks.sum(axis=0) == 1):
+    pass
+else:
+    sys.exit('Every parcel must belong to exactly one network. Check network indices. Exiting...')
+## sparse membership matrix (333 nonzeros) so all network sums come from one sparse matmul
+net_members = sparse.csr_matrix(net_masks, dtype=np.float64)
+net_sizes = net_masks.sum(axis=1)
+## network number of every parcel (from its mask column), to find each hub's own network
+parcel_net_map = net_masks.argmax(axis=0)
+
+def compute_profiles(zmat,hub_indices):
+    # hub profile kernel: (n_hubs, 13) average connectivity of each hub to each network
+    # get all connectivity values for the hubs - zero indexed rows
+    hub_rows = np.asarray(hub_indices, dtype=int) - 1
+    hub_conns = zmat[hub_rows]
+    hubs = np.arange(len(hub_rows))
+    # each hub's own index holds the self correlation
+    if np.all(hub_conns[hubs,hub_rows] == 1.0):
+        pass
+    else:
+        sys.exit('Something went wrong removing the self-corr value. Exiting...')
+    # network sums for all hubs at once - (13 x 333) sparse @ (333 x n_hubs) dense
+    net_sums = np.asarray(net_members @ hub_conns.T).T
+    net_counts = np.tile(net_sizes, (len(hub_rows),1))
+    # drop the self-corr from each hub's own network only
+    hub_nets = parcel_net_map[hub_rows]
+    net_sums[hubs,hub_nets] -= 1.0
+    net_counts[hubs,hub_nets] -= 1
+    profiles = net_sums / net_counts
+    return profiles
+
+def create_profiles(sub,zmat,hub_indices,conn_profiles_dir):
+    # make hub connectivity profiles & save to .txt
+    profiles = compute_profiles(zmat,hub_indices)
+    # round to the precision saved in the profile .txt files
+    profiles = np.round(profiles, 4)
+    hub_keys = [sub + '_' + str(hi) for hi in hub_indices]
+    conn_profiles = []
+    for hub_key,prof in zip(hub_keys,profiles):
+        avg_conns_list = [str(num) for num in prof]
+        profile_list = [hub_key] + avg_conns_list
+        profile = ' '.join(profile_list)
+        conn_profiles.append(profile)
+    ## write hub conn profiles to file for THIS SUBJECT
+    cp_outfile_path = os.path.join(conn_profiles_dir, sub + '_HUB_CONN_PROFILES.txt')
+    with open(cp_outfile_path, 'w') as f:
+        f.write(''.join(hcp + '\n' for hcp in conn_profiles))
+    ## binary copy (hub keys + profiles) for fast, exact reloading
+    np.savez(cp_outfile_path.replace('.txt','.npz'), keys=np.array(hub_keys), profiles=profiles)
+    return hub_keys, profiles
+
+def process_subject(sub,dist_cens_zmat_dir,hub_indices_dir,conn_profiles_dir):
+    # load one participant's zmat & hub indices and make their hub profiles
+    # get zmat (binary .npy copy is cached next to the csv for repeat runs)
+    zmat_file = os.path.join(dist_cens_zmat_dir,
+                            sub + '_DIST_CENSORED_ZMAT.csv')
+    zmat_npy = zmat_file.replace('.csv','.npy')
+    if os.path.isfile(zmat_npy) and os.path.getmtime(zmat_npy) >= os.path.getmtime(zmat_file):
+        zmat = np.load(zmat_npy, mmap_mode='r')
+    else:
+        zmat = np.loadtxt(zmat_file, delimiter=',')
+        np.save(zmat_npy, zmat)
+    # get hubs                   
+    hub_file = os.path.join(hub_indices_dir,
+                            sub + '_HUB_INDICES.txt') 
+    with open(hub_file, 'r') as f:
+        hub_indices = [i.strip() for i in f.readlines()]
+    # make ints
+    hub_indices = [int(i) for i in hub_indices]
+    ## create hub profiles
+    return create_profiles(sub,zmat,hub_indices,conn_profiles_dir)
+
 start_time=time.time()
 def main(argv=sys.argv):
     arg_parser = argparse.ArgumentParser(prog='Create_Hub_Profiles.py',
@@ -50,6 +133,31 @@ def main(argv=sys.argv):
                                  'Figure S3 (B).',
                             dest='orderlist'
                             )
+    arg_parser.add_argument('-npy', action='store_true', required=False,
+                            default=False,
+                            help='Save the hub profile correlation matrix as a binary .npy '
+                                 'file instead of .csv. Much faster for large cohorts. '
+                                 '(Default=False)',
+                            dest='npy'
+                            )
+    arg_parser.add_argument('-plot', action='store_true', required=False,
+                            default=False,
+                            help='Also save the (optional) hub profile correlation matrix plot. '
+                                 '(Default=False)',
+                            dest='plot'
+                            )
+    arg_parser.add_argument('-dpi', action='store', type=int, required=False,
+                            default=150,
+                            help='Resolution of the correlation matrix plot. Rendering time grows '
+                                 'with dpi squared, use 1200 for publication figures. (Default=150)',
+                            dest='dpi'
+                            )
+    arg_parser.add_argument('-jobs', action='store', type=int, required=False,
+                            default=1,
+                            help='Number of participants to make hub profiles for in parallel. '
+                                 '(Default=1)',
+                            dest='jobs'
+                            )
     arg_parser.add_argument('-v','--version', action='version', version='%(prog)s: ' + __version__)
     args = arg_parser.parse_args()
     # Setting up logger #
@@ -76,138 +184,79 @@ def main(argv=sys.argv):
     # Group name
     logger.debug(f'Group/File Name: {args.name}')
     ## quick numbers check:
-    ind_glob = glob.glob(os.path.join(hub_indices_dir,'*'))
-    z_glob = glob.glob(os.path.join(dist_cens_zmat_dir,'*'))
-    logger.debug(f'Hub Indices files found: {len(ind_glob)}')
-    logger.debug(f'zmat files found: {len(z_glob)} ')
+    ind_files = [e.name for e in os.scandir(hub_indices_dir) if e.name.endswith('_HUB_INDICES.txt')]
+    z_files = [e.name for e in os.scandir(dist_cens_zmat_dir) if e.name.endswith('_DIST_CENSORED_ZMAT.csv')]
+    logger.debug(f'Hub Indices files found: {len(ind_files)}')
+    logger.debug(f'zmat files found: {len(z_files)} ')
     logger.debug('------------------------- end ------------------------------------\n')
     here = os.path.dirname(os.path.abspath(__file__))
 
-    # Zero indexed network indices for averaging - ugly but works
-    aud = [9,63,64,65,66,67,68,69,76,101,103,159,170,223,226,229,231,232,238,243,267,268,328,329]
-    co = [20,21,26,27,33,39,62,70,71,75,80,81,83,100,102,104,110,111,146,152,179,180,184,186,187,
-        191,195,197,218,222,233,234,237,244,245,247,248,273,316,317]
-    cp = [11,88,92,172,253]
-    dmn = [0,3,5,24,25,43,93,113,115,116,125,126,144,145,149,150,151,153,155,156,161,164,183,185,
-        199,219,224,256,258,277,278,289,314,315,320,321,322,323,324,325,330]
-    da = [40,41,42,48,50,51,54,73,86,87,90,91,94,99,105,106,109,112,154,188,198,202,207,210,235,
-        249,251,252,261,265,270,274]
-    fp = [6,8,23,77,95,107,108,147,148,166,167,169,181,239,259,260,271,272,275,276,318,319,326,327]
-    none = [10,17,18,72,114,117,118,119,120,121,122,123,124,127,128,132,133,134,141,143,158,171,177,
-            178,279,280,281,282,283,284,285,286,287,288,290,291,295,296,299,300,301,302,303,304,305,311,313]
-    ret = [12,13,129,142,173,293,294,312]
-    sal = [28,82,182,246]
-    ssmh = [1,29,30,31,32,34,35,36,37,44,45,46,47,49,53,55,56,57,162,189,190,192,193,194,200,201,203,204,205,
-            206,208,209,212,213,214,215,216,269]
-    ssmm = [2,38,52,58,163,196,211,217]
-    va = [22,59,60,61,74,78,79,84,85,157,160,220,221,225,227,228,230,236,240,241,242,331,332]
-    vis = [4,7,14,15,16,19,89,96,97,98,130,131,135,136,137,138,139,140,165,168,174,175,176,250,254,255,257,
-        262,263,264,266,292,297,298,306,307,308,309,310]
-
-    def create_profiles(sub,zmat_file,hub_indices):
-        # make hub connectivity profiles & save to .txt
-        conn_profiles = []
-        for hi in hub_indices:
-            # get all connectivity values for that hub - as list for easy indexing
-            hi = hi - 1
-            all_hub_conns = zmat.loc[hi, :].values.tolist()
-            corr_removed = 0
-            # make list and check for the self correlation
-            ## SLOPPY but neurotic
-            aud_conns = [all_hub_conns[i] for i in aud] # 24 items
-            co_conns = [all_hub_conns[i] for i in co] # 40 items
-            cp_conns = [all_hub_conns[i] for i in cp] # 5 items
-            dmn_conns = [all_hub_conns[i] for i in dmn] # 41 items
-            da_conns = [all_hub_conns[i] for i in da] # 32 items
-            fp_conns = [all_hub_conns[i] for i in fp] # 24 items
-            none_conns = [all_hub_conns[i] for i in none] # 47 items
-            ret_conns = [all_hub_conns[i] for i in ret] # 8 items
-            sal_conns = [all_hub_conns[i] for i in sal] # 4 items
-            ssmh_conns = [all_hub_conns[i] for i in ssmh] # 38 items
-            ssmm_conns = [all_hub_conns[i] for i in ssmm] # 8 items
-            va_conns = [all_hub_conns[i] for i in va] # 23 items
-            vis_conns = [all_hub_conns[i] for i in vis] # 39 items
-            net_conns = [aud_conns,co_conns,cp_conns,dmn_conns,da_conns,
-                        fp_conns,none_conns,ret_conns,sal_conns,ssmh_conns,
-                        ssmm_conns,va_conns,vis_conns]
-            for nc in net_conns:
-                if 1.0 in nc:
-                    corr_removed = corr_removed + 1
-                    nc.remove(1.0)
-                else:
-                    pass
-            if corr_removed == 1:
-                pass
-            else:
-                sys.exit('Something went wrong removing the self-corr value. Exiting...')
-            avg_conns_list = [np.mean(aud_conns),np.mean(co_conns),np.mean(cp_conns),
-                            np.mean(dmn_conns),np.mean(da_conns),np.mean(fp_conns),
-                            np.mean(none_conns),np.mean(ret_conns),np.mean(sal_conns),
-                            np.mean(ssmh_conns),np.mean(ssmm_conns),np.mean(va_conns),
-                            np.mean(vis_conns)]
-            avg_conns_list = [str(round(num, 4)) for num in avg_conns_list]
-            profile_list = [sub + '_' + str(hi + 1)] + avg_conns_list
-            profile = ' '.join(profile_list)
-            conn_profiles.append(profile)   
-        ## write hub conn profiles to file for THIS SUBJECT
-        cp_outfile_path = os.path.join(conn_profiles_dir, sub + '_HUB_CONN_PROFILES.txt')
-        f = open(cp_outfile_path, 'w')
-        for hcp in conn_profiles:
-            hcp_line = (str(hcp),'\n')
-            f.write(' '.join(hcp_line))
-        f.close()
-        
-    def make_corr(IDorder):
+    def make_corr(IDorder, hub_profiles):
         # Create and save hub profile matrix. 
-        hcprofiles_dict = {}
+        sub_results = []
         for sub in IDorder:
-            hc_profile_path = os.path.join(conn_profiles_dir, sub + '_HUB_CONN_PROFILES.txt')
-            with open(hc_profile_path, 'r') as f:
-                for i in f.readlines():
-                    hcp_vect = i.strip()
-                    hcp_vect = [i for i in hcp_vect.split()]
-                    the_key = hcp_vect[0]
-                    # remove key string & convert to floats
-                    del hcp_vect[0]
-                    hcp_vect = [float(i) for i in hcp_vect]
-                    hcprofiles_dict[the_key] = hcp_vect
-        ## put lists into a dataframe and correlate for louvain
-        all_hubprofs_df = pd.DataFrame(hcprofiles_dict)
-        prof_corr = all_hubprofs_df.corr(method='pearson')
-        ## Save prof_corr as .csv
-        logger.debug(f'Saving hub profile correlation matrix .csv for clustering...')
-        out_mat_path = os.path.join(args.outdir,args.name + '_Hub_Profile_CorrMat.csv')
-        np.savetxt(out_mat_path,prof_corr,fmt='%f',delimiter=',')
+            if sub in hub_profiles:
+                # made in step I - already in memory
+                sub_keys, sub_profs = hub_profiles[sub]
+            else:
+                # not made this run - load from saved hub profile files (binary copy if current)
+                hc_profile_path = os.path.join(conn_profiles_dir, sub + '_HUB_CONN_PROFILES.txt')
+                hc_profile_npz = hc_profile_path.replace('.txt','.npz')
+                if os.path.isfile(hc_profile_npz) and os.path.getmtime(hc_profile_npz) >= os.path.getmtime(hc_profile_path):
+                    with np.load(hc_profile_npz) as hc_npz:
+                        sub_keys = hc_npz['keys'].tolist()
+                        sub_profs = hc_npz['profiles']
+                else:
+                    sub_keys = np.loadtxt(hc_profile_path, usecols=0, dtype=str, ndmin=1).tolist()
+                    sub_profs = np.loadtxt(hc_profile_path, usecols=range(1,len(networks) + 1), ndmin=2)
+            sub_results.append((sub_keys, sub_profs))
+        ## fill one preallocated profile array (one row per hub) and pearson correlate for louvain
+        n_hubs_total = sum(len(sub_keys) for sub_keys,_ in sub_results)
+        all_hubprofs = np.empty((n_hubs_total,len(networks)))
+        all_keys = []
+        offset = 0
+        for sub_keys,sub_profs in sub_results:
+            all_hubprofs[offset:offset + len(sub_keys)] = sub_profs
+            all_keys.extend(sub_keys)
+            offset += len(sub_keys)
+        # center & unit-normalize each hub profile in place, then one (n_hubs x n_hubs) product
+        all_hubprofs -= all_hubprofs.mean(axis=1, keepdims=True)
+        all_hubprofs /= np.linalg.norm(all_hubprofs, axis=1, keepdims=True)
+        prof_corr = all_hubprofs @ all_hubprofs.T
+        np.clip(prof_corr, -1, 1, out=prof_corr)
+        ## Save prof_corr as .csv (or binary .npy - much faster to write/read for large cohorts)
+        if args.npy:
+            logger.debug(f'Saving hub profile correlation matrix .npy for clustering...')
+            out_mat_path = os.path.join(args.outdir,args.name + '_Hub_Profile_CorrMat.npy')
+            np.save(out_mat_path,prof_corr)
+        else:
+            logger.debug(f'Saving hub profile correlation matrix .csv for clustering...')
+            out_mat_path = os.path.join(args.outdir,args.name + '_Hub_Profile_CorrMat.csv')
+            np.savetxt(out_mat_path,prof_corr,fmt='%f',delimiter=',')
         # Draw the heatmap with the mask and correct aspect ratio (not very useful at this stage)
-        logger.debug(f'Saving hub profile correlation plot (not really useful at this stage)...')
-        sns.heatmap(prof_corr, vmin=-1, vmax=1, center= 0, cmap= 'coolwarm')
-        plt.savefig(os.path.join(args.outdir,f'{args.name}_Hub_Profile_Correlations.png'), dpi=1200, format='png', bbox_inches='tight')
+        if args.plot:
+            logger.debug(f'Saving hub profile correlation plot (not really useful at this stage)...')
+            prof_corr_df = pd.DataFrame(prof_corr, index=all_keys, columns=all_keys) # hub labels for the plot axes
+            sns.heatmap(prof_corr_df, vmin=-1, vmax=1, center= 0, cmap= 'coolwarm')
+            plt.savefig(os.path.join(args.outdir,f'{args.name}_Hub_Profile_Correlations.png'), dpi=args.dpi, format='png', bbox_inches='tight')
+            plt.close()
 
     ### SCRIPT ENTRY ###
     ## MAKE subject list
-    sub_list = []
-    for x in ind_glob:
-        the_file = os.path.basename(x)
-        subid = the_file.replace('_HUB_INDICES.txt','')
-        sub_list.append(subid)
+    sub_list = [the_file.replace('_HUB_INDICES.txt','') for the_file in ind_files]
     # I. Make hub profiles
-    for sub in sub_list:
-        logger.debug(f'Working on {sub}...')
-        # get zmat
-        zmat_file = os.path.join(dist_cens_zmat_dir,
-                                sub + '_DIST_CENSORED_ZMAT.csv')
-        zmat = pd.read_csv(zmat_file, header=None)
-        # get hubs                   
-        hub_file = os.path.join(hub_indices_dir,
-                                sub + '_HUB_INDICES.txt') 
-        with open(hub_file, 'r') as f:
-            hub_indices = [i.strip() for i in f.readlines()]
-        # make ints
-        hub_indices = [int(i) for i in hub_indices]
-        ## create hub profiles
-        create_profiles(sub,zmat_file,hub_indices)
-        # quick check profile files made (match to expected participants)
-        all_conn_profiles = glob.glob(os.path.join(conn_profiles_dir,'*'))
+    hub_profiles = {}
+    # (participants are independent, so they are run across -jobs worker processes)
+    run_subject = functools.partial(process_subject,
+                                    dist_cens_zmat_dir=dist_cens_zmat_dir,
+                                    hub_indices_dir=hub_indices_dir,
+                                    conn_profiles_dir=conn_profiles_dir)
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        for sub,sub_profiles in zip(sub_list, executor.map(run_subject, sub_list)):
+            logger.debug(f'Hub profiles made: {sub}')
+            hub_profiles[sub] = sub_profiles
+    # quick check profile files made (match to expected participants)
+    all_conn_profiles = [e.name for e in os.scandir(conn_profiles_dir) if e.name.endswith('_HUB_CONN_PROFILES.txt')]
     logger.debug(f'Hub profiles made for {len(all_conn_profiles)} participants.\n')
     # II. Make profile corr mat
     if args.orderlist:
@@ -220,7 +269,7 @@ def main(argv=sys.argv):
             sys.exit(f'ID order list file not found. Check path: {args.orderlist}')
     else:
         IDorder = sub_list
-    make_corr(IDorder)
+    make_corr(IDorder, hub_profiles)
 
     full_runtime = time.time() - start_time
     print('\nFull Script Runtime: ' + str(datetime.timedelta(seconds=round(full_runtime))))
@@ -23,12 +23,317 @@ https://doi.org/10.1016/j.celrep.2023.112521
 """
 __version__ = "0.1.0"
 
-import argparse,bct,datetime,glob,logging,os,random,shutil,subprocess,sys,time
-import networkx as nx
+import argparse,datetime,functools,glob,logging,os,random,shutil,subprocess,sys,tempfile,time,types
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import nibabel as nb
 import numpy as np
 from scipy import stats
 
+## global vars
+logger = logging.getLogger()
+here = os.path.dirname(os.path.abspath(__file__))
+mult_mat_path = os.path.join(here,'COMBINED333_LR_Distance_MULTIPLICATION_MASK.csv')
+gordon_parcel_path = os.path.join(here,'Parcels_LR.dlabel.nii')
+threshold_list = [0.003, 0.004, 0.005, .01, .015, .02, .025, .03, .035, .04, .045, .05]
+worker_mult_mat = None # -jobs workers: read-only memory mapped distance mask (set by init_worker)
+
+@functools.lru_cache(maxsize=1)
+def upper_indices(n):
+    # (row-major) upper triangle indices - the pipeline works on this P(P-1)/2 link vector, not full PxP matrices
+    return np.triu_indices(n, 1)
+
+def make_zmat(preprocd_ts):
+    # pearson r as one BLAS product: center & unit-normalize each parcel timeseries first
+    ts_norm = preprocd_ts - preprocd_ts.mean(axis=1, keepdims=True)
+    ts_norm /= np.linalg.norm(ts_norm, axis=1, keepdims=True)
+    sub_corr_mat = ts_norm @ ts_norm.T
+    # fisher z of the upper triangle links only (matrix is symmetric, diagonal is not used)
+    ztrans_upper = np.arctanh(np.clip(sub_corr_mat[upper_indices(len(sub_corr_mat))], -1, 1))
+    return ztrans_upper
+
+def dist_censor(subid, ztrans_upper, mult_mat, args):
+    n = len(mult_mat)
+    iu = upper_indices(n)
+    dist_censored_upper = ztrans_upper * mult_mat[iu]
+    dist_censored_upper[dist_censored_upper==-0]=0 # correct -0 for aesthetics
+    # save distance censored csvs for later steps (full matrix only here: z diagonal of 1 x mask diagonal)
+    dist_censored_zmat = np.diag(np.diagonal(mult_mat) * 1.0)
+    dist_censored_zmat[iu] = dist_censored_upper
+    dist_censored_zmat.T[iu] = dist_censored_upper
+    dist_censored_zmat[dist_censored_zmat==-0]=0
+    csv_dir = os.path.join(args.outdir,'final_csv_outputs')
+    if os.path.isdir(csv_dir):
+        pass
+    else:
+        os.makedirs(csv_dir)
+    out_mat_path = os.path.join(csv_dir,subid + '_DIST_CENSORED_ZMAT.csv')
+    np.savetxt(out_mat_path,dist_censored_zmat,fmt='%f',delimiter=',')
+    return dist_censored_upper
+
+def teachers_round(x):
+    # round .5 up (matlab/bct rounding for the number of kept links), not python's round half to even
+    if ((x > 0) and (x % 1 >= 0.5)) or ((x < 0) and (x % 1 > 0.5)):
+        return int(np.ceil(x))
+    else:
+        return int(np.floor(x))
+
+def n_kept_links(thresh, n):
+    # number of (undirected) links kept at a proportional threshold (as bct.threshold_proportional)
+    return teachers_round((n * n - n) * float(thresh) / 2)
+
+def sort_upper_edges(z_upper, n):
+    # sort the upper triangle links ONCE per participant - every proportional threshold is a prefix of this order
+    # (same links & descending order as bct.threshold_proportional uses for a symmetric matrix)
+    iu = upper_indices(n)
+    link_idx = np.flatnonzero(z_upper)
+    edge_rows, edge_cols = iu[0][link_idx], iu[1][link_idx]
+    edge_weights = z_upper[link_idx]
+    # only the strongest links of the largest threshold are ever kept - partition those out (O(N)), then sort just them
+    max_kept = n_kept_links(max(threshold_list), n)
+    if max_kept < len(edge_weights):
+        edge_order = np.argpartition(edge_weights, len(edge_weights) - max_kept)[len(edge_weights) - max_kept:]
+        edge_order = edge_order[np.argsort(edge_weights[edge_order])[::-1]]
+    else:
+        edge_order = np.argsort(edge_weights)[::-1]
+    return edge_rows, edge_cols, edge_weights, edge_order
+
+def threshold_edges(sorted_edges, thresh, n):
+    # keep the strongest proportion of links (as bct.threshold_proportional) - returned in upper triangle (row-major) order
+    edge_rows, edge_cols, edge_weights, edge_order = sorted_edges
+    en = n_kept_links(thresh, n) # number of links to be preserved
+    keep = np.sort(edge_order[:en])
+    return edge_rows[keep], edge_cols[keep], edge_weights[keep]
+
+@functools.lru_cache(maxsize=1)
+def pajek_vertices(n):
+    # pajek vertex block (exactly as networkx.write_pajek wrote it) - same for every participant & threshold
+    return ''.join([f'*vertices {n}\n'] + [f'{i + 1} {i} 0.0 0.0 ellipse\n' for i in range(n)])
+
+def write_pajek(pajek_path, edge_rows, edge_cols, edge_weights, n):
+    # pajek is plain text: vertex block + 1 indexed upper triangle edge list (weights at full repr precision)
+    edge_lines = ''.join(f'{r} {c} {w}\n' for r,c,w in zip((edge_rows + 1).tolist(),
+                                                            (edge_cols + 1).tolist(),
+                                                            edge_weights.tolist()))
+    with open(pajek_path, 'w') as f:
+        f.write(pajek_vertices(n) + '*edges\n' + edge_lines)
+
+def _run_one_threshold(subid, n, sorted_edges, thresh, rand_num, args):
+    ##  threshold distance censored zmat
+    infomap_out_dir = os.path.join(args.outdir,'infomap_outputs')
+    pajek_out_dir = os.path.join(args.outdir,'pajek_files')
+    edge_rows, edge_cols, edge_weights = threshold_edges(sorted_edges, thresh, n)
+    check_nan = np.isnan(np.sum(edge_weights))
+    if check_nan == True:
+        sys.exit('NaN found. This is not right! Exiting...')
+    else:
+        pass
+    logger.debug(f'  -Creating pajek file: {thresh}')
+    ## write the sparse edge list (upper triangle links) straight to pajek - no graph object needed
+    pajek_path = os.path.join(pajek_out_dir,
+                              subid + '_' + str(thresh) + '_upper_mat.net')
+    write_pajek(pajek_path, edge_rows, edge_cols, edge_weights, n)
+    ##  subprocess infomap
+    output_name = os.path.basename(pajek_path).replace('.net','')
+    infomap_comm = ['infomap',pajek_path,infomap_out_dir,
+                    '--clu', # cluster indices for all nodes
+                    '-2', # two-level (confirmed with EG)
+                    '-s', str(rand_num), # picking random number for the seed of the internal random number generator
+                    '-N', str(args.attempts), # number of attempts (iterations) for infomap
+                    '--out-name', output_name, # Naming for output files (to not overwrite pajek...)
+                    '--silent'
+                    ]
+    logger.debug(f'  - Running infomap ({args.attempts} iterations) silently')
+    # exec infomap directly (no shell, so paths with spaces are safe) & stop if it fails
+    try:
+        subprocess.run(infomap_comm, check=True)
+    except FileNotFoundError:
+        sys.exit('infomap not found. Infomap must be installed and callable from the command line.')
+    except subprocess.CalledProcessError as e:
+        sys.exit(f'infomap failed (exit code {e.returncode}) on pajek file: {pajek_path}')
+
+def run_infomap(subid, n, sorted_edges, infomap_seeds, args):
+    ##  Make pajek & run infomap
+    infomap_out_dir = os.path.join(args.outdir,'infomap_outputs')
+    for f in glob.glob(os.path.join(infomap_out_dir,subid + '_*')):
+        os.remove(f)
+    # thresholds are independent & the heavy lifting is in the infomap child process, so threads suffice
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        list(executor.map(lambda thr_seed: _run_one_threshold(subid, n, sorted_edges, thr_seed[0], thr_seed[1], args),
+                          zip(threshold_list,infomap_seeds)))
+    ## clean up affiliation vector and save to file. 
+    logger.debug(f'  -Cleaning up clu files and saving affiliation vectors')
+    aff_vects = []
+    for thresh in threshold_list:
+        cf = os.path.join(infomap_out_dir,f'{subid}_{thresh}_upper_mat.clu')
+        if os.path.isfile(cf):
+            pass
+        else:
+            sys.exit(f'Infomap clu file not found. Check infomap output: {cf}')
+        ## parcel (node_id) & community (module) columns, ordered by the parcel numbers
+        clu_tups = np.loadtxt(cf, comments='#', usecols=(0,1), dtype=np.int32, ndmin=2)
+        clu_tups = clu_tups[clu_tups[:,0].argsort()]
+        aff_ref_path = cf.replace('_upper_mat.clu','_aff_vect_REF.txt')
+        aff_vect_path = cf.replace('_upper_mat.clu','_aff_vect.txt')
+        ## write to the affiliation vector REFERENCE first (reference has the parcel number also)
+        np.savetxt(aff_ref_path, clu_tups, fmt='%d')
+        ## next write affiliation vector. (communities only - also kept in memory for PC step)
+        np.savetxt(aff_vect_path, clu_tups[:,1], fmt='%d')
+        aff_vects.append(clu_tups[:,1])
+    return aff_vects
+
+def run_pc_steps(subid, n, sorted_edges, aff_vects, args):
+    ## Step 6,7,8, and 9: Calc PC, get percents, censor out low degree nodes, get average percent, and save as file. 
+    # all thresholds at once - every array below is (threshold, parcel)
+    logger.debug(f'   all thresh - calc pc, get percents, censor low degree nodes, avg percs, save file...')
+    pc_outputs_dir = os.path.join(args.outdir,'pc_outputs')
+    n_thr = len(threshold_list)
+    ## re-threshold (and take upper mat only) original dist censored matrix - from the already sorted links
+    thr_edges = [threshold_edges(sorted_edges, thr, n) for thr in threshold_list]
+    edge_thr = np.concatenate([np.full(len(te[0]), t) for t,te in enumerate(thr_edges)])
+    edge_rows = np.concatenate([te[0] for te in thr_edges])
+    edge_cols = np.concatenate([te[1] for te in thr_edges])
+    edge_weights = np.concatenate([te[2] for te in thr_edges])
+    ## calc PC with AND without nans (bct participation_coef, undirected) - aff_vects from the infomap step
+    ci = np.stack([np.unique(aff_vect, return_inverse=True)[1] for aff_vect in aff_vects])
+    n_comms = ci.max() + 1
+    # community-specific strength of every node at every threshold in one weighted bincount over the kept links only
+    Kc = np.bincount((edge_thr * n + edge_rows) * n_comms + ci[edge_thr, edge_cols],
+                     weights=edge_weights, minlength=n_thr * n * n_comms).reshape(n_thr, n, n_comms)
+    Ko = np.sum(Kc, axis=2)  # (out) degree
+    # Kc is not needed after this, so square it in place (no second (threshold, parcel, community) temp array)
+    PC_wnans = np.ones((n_thr, n)) - np.sum(np.square(Kc, out=Kc), axis=2) / np.square(Ko)
+    # without nans: bct sets zero degree nodes to 0
+    PC_nonans = PC_wnans.copy()
+    PC_nonans[Ko == 0] = 0
+    ## retain nan mask so we can put them back in when needed
+    PC_nan_mask = np.isnan(PC_wnans)
+    ## get PC percs with original (to avoid nan error and following adult paper methods)
+    # (percentileofscore kind='rank' of every element == average rank scaled to 100 - one sort, no python loop)
+    PC_percs = stats.rankdata(PC_nonans, axis=1) * (100.0 / n)
+    ## Censor out any low degree (<25th perc) nodes
+    degs = np.bincount(edge_thr * n + edge_cols, minlength=n_thr * n).reshape(n_thr, n) # bct.degrees_und (column link counts)
+    low_deg = degs < np.percentile(degs, 25, axis=1, keepdims=True)
+    ## censored nodes (low degree + nans from PC step) become nans for nanmean function later
+    allPC_percs_wnans = PC_percs # (PC_percs not used again)
+    allPC_percs_wnans[low_deg | PC_nan_mask] = np.float64('nan')
+    # Save as text files for later
+    for thr,cens_PC_perc_wnan in zip(threshold_list,allPC_percs_wnans):
+        pc_perc_path = os.path.join(pc_outputs_dir,f'{subid}_{thr}_CENS_PC_PERC.txt')
+        np.savetxt(pc_perc_path, cens_PC_perc_wnan, fmt='%s') # %s = full precision repr (as str(float))
+    logger.debug(f'   -Complete: Degree censor & PC cals/perc per thresh')
+
+    ## Now get the average across percentiles using nanmean
+    logger.debug(f'  -Averaging PC percentiles')
+    ## average across thresholds
+    avg_PC_perc = np.nanmean(allPC_percs_wnans, axis=0)
+    avg_PC_perc = np.nan_to_num(avg_PC_perc) 
+    ## Save subject's avg pc percentage vect as .txt for later
+    avg_pc_dir = os.path.join(args.outdir,'final_avg_pc_percs')
+    avg_pc_path = os.path.join(avg_pc_dir,f'{subid}_FINAL_AVG_PC_PERCENTAGE.txt')
+    np.savetxt(avg_pc_path, avg_PC_perc, fmt='%s')
+
+    logger.debug(f'   AVG degree censored PC file calculated and saved.')
+
+@functools.lru_cache(maxsize=1)
+def load_template(template_path):
+    # Gordon template dlabel is the same for every participant - decode it once per process
+    # (returned read-only: every participant shares these objects, so none of them may edit the template)
+    img = nb.load(template_path)
+    image_data = np.asarray(img.get_fdata(),dtype=np.int16)  # here I retain the shape of the dataobj
+    image_data.flags.writeable = False
+    cifti_header = img.header
+    label_dict = types.MappingProxyType(cifti_header.get_axis(0).label[0])
+    brainmodel = cifti_header.get_axis(1)
+    return image_data, label_dict, brainmodel
+
+def label_hubs(subid, overlay_color, args):
+    # Step 10: Label parcels above 80 as a hub
+    # Load average, degree censored, PC percentile file:
+    pc_percs_dir = os.path.join(args.outdir,'final_avg_pc_percs')
+    avg_perc_path = os.path.join(pc_percs_dir,f'{subid}_FINAL_AVG_PC_PERCENTAGE.txt')
+    avg_vect = np.loadtxt(avg_perc_path)
+    ## added per EG - 5.3.21 - get percentile rank of avg perc values
+    final_avg_perc_vect = stats.rankdata(avg_vect) * (100.0 / avg_vect.size)
+    cens_avg_vect = np.where(final_avg_perc_vect < 80, 0, final_avg_perc_vect)
+    hub_indices = np.asarray(np.nonzero(cens_avg_vect)[0])
+    ## add 1 to adjust for python 0 indexing to get parcel # of hub(s)
+    hub_indices = hub_indices + 1
+    logger.debug(f'  -Number of hubs found: {hub_indices.shape[0]}')
+    ## SAVE HUB indices for density map creation
+    hub_indices_dir = os.path.join(args.outdir,'final_hub_indices')
+    hub_indices_path = os.path.join(hub_indices_dir,f'{subid}_HUB_INDICES.txt')
+    np.savetxt(hub_indices_path, hub_indices, fmt='%d')
+    logger.debug('   -Hub index text file saved')
+
+    ### Make basic dlabel of hubs
+    logger.debug('  -BONUS: Auto-create hub dlabel.nii file')
+    ## Load template dlabel (cached) and get the original LabelAxis as a dict....
+    image_data, template_label_dict, brainmodel = load_template(gordon_parcel_path)
+    label_dict = template_label_dict.copy() # editable dict copy (entries are replaced, never mutated, below)
+    ## edit dict to highlight hubs
+    # iterate over parcels in label dict. If not a hub = half transparent. If hub, change color and label name. 
+    label_keys = np.fromiter(label_dict.keys(), dtype=int, count=len(label_dict))
+    is_hub = np.isin(label_keys, hub_indices)
+    hub_number = 1
+    for lab, lab_is_hub in zip(label_keys.tolist(), is_hub.tolist()):
+        if lab_is_hub:
+            # label and color as a hub
+            logger.debug(f'   -found hub {hub_number}')
+            label_dict[lab] = (f'    -Subject_Hub_{hub_number}', overlay_color) 
+            hub_number = hub_number + 1
+        else:
+            if lab == 0:
+                pass
+            else:
+                parc_name = label_dict[lab][0]
+                tup_list = list(label_dict[lab][1])
+                tup_list[-1] = 0
+                color_tup = tuple(tup_list)
+                label_dict[lab] = (parc_name, color_tup)
+    ## make the new dict a LabelAxis object
+    updated_hub_axis = nb.cifti2.LabelAxis([""], label_dict)
+    ## finally, use new label axis and original brain model and write the new file out
+    dlabel_output_dir = os.path.join(args.outdir,'final_hubs_dlabels')
+    new_header = nb.cifti2.cifti2_axes.to_header([updated_hub_axis, brainmodel])
+    new_cifti = nb.cifti2.Cifti2Image(image_data, new_header)
+    dlabel_path = os.path.join(dlabel_output_dir,f'{subid}.dlabel.nii')
+    new_cifti.to_filename(dlabel_path)
+    logger.debug(f'  -Hub surface dlabel.nii file made: {dlabel_path}')
+
+def process_subject(entry, infomap_seeds, args, overlay_color, mult_mat=None):
+    # Full hub pipeline for one participant data entry (independent of all other participants)
+    if mult_mat is None:
+        mult_mat = worker_mult_mat
+    subid = entry.split(' ')[0]
+    ts_path = entry.split(' ')[1]
+    preprocd_ts = np.loadtxt(ts_path)
+    logger.debug(f'{subid}')
+    # I. Create z transformed corr mat
+    logger.debug(f' -Creating zmat and distance censoring')
+    n = len(preprocd_ts) # number of parcels (vertices)
+    ztrans_upper = make_zmat(preprocd_ts)
+    # II. Distance censor zmat
+    dist_censored_upper = dist_censor(subid, ztrans_upper, mult_mat, args)
+    # sort links once - shared by the infomap & PC thresholding
+    sorted_edges = sort_upper_edges(dist_censored_upper, n)
+    # III. Run infomap
+    logger.debug(f' -Running infomap at all thresholds')
+    aff_vects = run_infomap(subid, n, sorted_edges, infomap_seeds, args)
+    # IV. Calculate PC, get percs, censor, avg percs, save file
+    logger.debug(f' -Running Participation Coefficient steps')
+    run_pc_steps(subid, n, sorted_edges, aff_vects, args)
+    # V. Identify/Label hubs, make indices file, create hubs dlabel file
+    logger.debug(f' -Identifying hub parcels')
+    label_hubs(subid, overlay_color, args)
+    return subid
+
+def init_worker(mult_mat_npy):
+    # worker processes log the same way as the main process & map the one shared copy of the distance mask
+    global worker_mult_mat
+    logging.basicConfig(level=logging.DEBUG, format='%(message)s')
+    logger.setLevel(logging.DEBUG)
+    worker_mult_mat = np.load(mult_mat_npy, mmap_mode='r')
+
 start_time=time.time()
 def main(argv=sys.argv):
     arg_parser = argparse.ArgumentParser(prog='Identify_Hubs.py',
@@ -50,6 +355,19 @@ def main(argv=sys.argv):
                             help='Number of Infomap iteration attempts. (Default=1,000)',
                             dest='attempts'
                             )
+    arg_parser.add_argument('-jobs', action='store', type=int, required=False,
+                            default=1,
+                            help='Number of participants to process in parallel. Each job runs its '
+                                 'own infomap processes, so keep this at or below your CPU count. '
+                                 '(Default=1)',
+                            dest='jobs'
+                            )
+    arg_parser.add_argument('-threads', action='store', type=int, required=False,
+                            default=1,
+                            help='Number of thresholds to run through infomap at once '
+                                 'within each participant. (Default=1)',
+                            dest='threads'
+                            )
     arg_parser.add_argument('-nocleanup', action='store_true', required=False,
                             default=False,
                             help='Suppress temporary file cleanup. '
@@ -71,7 +389,6 @@ def main(argv=sys.argv):
     args = arg_parser.parse_args()
     # Setting up logger #
     logging.basicConfig(level=logging.DEBUG, format='%(message)s')
-    logger = logging.getLogger()
     logger.setLevel(logging.DEBUG)
     logger.debug('\n--------------------- setup info ---------------------------------')
     # load & clean input data list
@@ -108,268 +425,26 @@ def main(argv=sys.argv):
         logger.debug(f'Hub Overlay Color: Lime')
 
     logger.debug('------------------------- end ------------------------------------\n')
-    ## global vars
-    here = os.path.dirname(os.path.abspath(__file__))
-    mult_mat_path = os.path.join(here,'COMBINED333_LR_Distance_MULTIPLICATION_MASK.csv')
-    gordon_parcel_path = os.path.join(here,'Parcels_LR.dlabel.nii')
-    threshold_list = [0.003, 0.004, 0.005, .01, .015, .02, .025, .03, .035, .04, .045, .05]
-
-    def make_zmat(preprocd_ts):
-        sub_corr_mat = np.corrcoef(preprocd_ts)
-        np.fill_diagonal(sub_corr_mat,0)
-        ztrans_mat = np.arctanh(sub_corr_mat)
-        np.fill_diagonal(ztrans_mat,1)
-        return ztrans_mat
-    
-    def dist_censor(ztrans_mat):
-        mult_mat = np.genfromtxt(mult_mat_path, delimiter=',')
-        dist_censored_zmat = ztrans_mat.copy()
-        dist_censored_zmat = dist_censored_zmat * mult_mat
-        dist_censored_zmat[dist_censored_zmat==-0]=0 # correct -0 for aesthetics
-        # save distance censored csvs for later steps
-        csv_dir = os.path.join(args.outdir,'final_csv_outputs')
-        if os.path.isdir(csv_dir):
-            pass
-        else:
-            os.makedirs(csv_dir)
-        out_mat_path = os.path.join(csv_dir,subid + '_DIST_CENSORED_ZMAT.csv')
-        np.savetxt(out_mat_path,dist_censored_zmat,fmt='%f',delimiter=',')
-        return dist_censored_zmat
-
-    def run_infomap(subid, ready_zmat):
-        ##  Make pajek & run infomap
-        infomap_out_dir = os.path.join(args.outdir,'infomap_outputs')
-        pajek_out_dir = os.path.join(args.outdir,'pajek_files')
-        for f in glob.glob(os.path.join(infomap_out_dir,subid + '*')):
-            os.remove(f)
-        for thresh in threshold_list:  
-            ##  threshold distance censored zmat
-            thresh_mat = bct.threshold_proportional(ready_zmat, float(thresh),copy=True)
-            check_nan = np.isnan(np.sum(thresh_mat))
-            if check_nan == True:
-                sys.exit('NaN found. This is not right! Exiting...')
-            else:
-                pass
-            logger.debug(f'  -Creating pajek file: {thresh}')
-            nx_graph = nx.from_numpy_matrix(thresh_mat)
-            pajek_path = os.path.join(pajek_out_dir,
-                                      subid + '_' + str(thresh) + '_upper_mat.net')
-            nx.write_pajek(nx_graph,pajek_path)
-            ##  subprocess infomap
-            output_name = os.path.basename(pajek_path).replace('.net','')
-            rand_num = random.randint(1,9999)
-            infomap_comm = ' '.join(['infomap',pajek_path,infomap_out_dir,
-                                     '--clu', # cluster indices for all nodes
-                                     '-2', # two-level (confirmed with EG)
-                                     '-s ' + str(rand_num), # picking random number for the seed of the internal random number generator
-                                     '-N ' + str(args.attempts), # number of attempts (iterations) for infomap
-                                     '--out-name ' + output_name, # Naming for output files (to not overwrite pajek...)
-                                     '--silent'
-                                     ])
-            logger.debug(f'  - Running infomap ({args.attempts} iterations) silently')
-            subprocess.call(infomap_comm, shell=True)
-        ## clean up affiliation vector and save to file. 
-        clu_files = glob.glob(os.path.join(infomap_out_dir,f'{subid}*'))
-        logger.debug(f'  -Cleaning up clu files and saving affiliation vectors')
-        for cf in clu_files:
-            if os.path.isdir(cf):
-                pass
-            else:
-                clu_tup = []
-                with open(cf, "r") as clu_file:
-                    for line in clu_file:
-                        stripped_line = line.strip()
-                        if '#' in stripped_line:
-                            pass
-                        else:
-                            sl = stripped_line.split(' ')
-                            clu_tup.append((int(sl[0]),int(sl[1])))
-                clu_file.close()
-                aff_ref_path = cf.replace('_upper_mat.clu','_aff_vect_REF.txt')
-                aff_vect_path = cf.replace('_upper_mat.clu','_aff_vect.txt')
-                ## order the tuples by the parcel numbers
-                s_tups = sorted(clu_tup, key=lambda x: x[0])
-                ## write to the affiliation vector REFERENCE first (reference has the parcel number also)
-                f = open(aff_ref_path, 'w')
-                for c in s_tups:
-                    c_line = (str(c[0]),str(c[1]),'\n')
-                    f.write(' '.join(c_line))
-                f.close()
-                ## next write affiliation vector. (communities only to import for PC step)
-                f = open(aff_vect_path, 'w')
-                for c in s_tups:
-                    c_line = (str(c[1]),'\n')
-                    f.write(' '.join(c_line))
-                f.close() 
-
-    def run_pc_steps(subid):
-        ## Step 6,7,8, and 9: Calc PC, get percents, censor out low degree nodes, get average percent, and save as file. 
-        logger.debug(f'  -Load distance censored zmat')
-        orig_distcensored_mat_path = os.path.join(args.outdir,
-                                                  'final_csv_outputs',
-                                                  subid + '_DIST_CENSORED_ZMAT.csv')
-        orig_dist_censored_zmat = np.genfromtxt(orig_distcensored_mat_path, delimiter=',')
-        pc_outputs_dir = os.path.join(args.outdir,'pc_outputs')
-        for thr in threshold_list:
-            logger.debug(f'   thresh: {thr} - calc pc, get percents, censor low degree nodes, avg percs, save file...')
-            ## re-threshold (and take upper mat only) original dist censored matrix
-            pc_thresh_mat = bct.threshold_proportional(orig_dist_censored_zmat, float(thr))
-            pc_upper_mat = np.triu(pc_thresh_mat,1)
-            ## load that threshold's affiliation vector created from infomap step
-            vect_text = os.path.join(args.outdir,
-                                     'infomap_outputs',
-                                     '_'.join([subid,str(thr),'aff','vect.txt'])
-                                    )
-            aff_vect = np.loadtxt(vect_text)
-            ## calc PC with AND without nans
-            PC_nonans = bct.participation_coef(pc_upper_mat, aff_vect, degree='undirected')
-            # with nans:
-            W = pc_upper_mat
-            ci = aff_vect
-            degree = 'undirected'
-            if degree == 'in':
-                W = W.T
-            _, ci = np.unique(ci, return_inverse=True)
-            ci += 1
-            n = len(W)  # number of vertices
-            Ko = np.sum(W, axis=1)  # (out) degree
-            Gc = np.dot((W != 0), np.diag(ci))  # neighbor community affiliation
-            Kc2 = np.zeros((n,))  # community-specific neighbors
-            for i in range(1, int(np.max(ci)) + 1):
-                Kc2 += np.square(np.sum(W * (Gc == i), axis=1))
-            P = np.ones((n,)) - Kc2 / np.square(Ko)
-            PC_wnans = P
-            ## retain nan mask so we can put them back in when needed
-            PC_nan_mask = np.argwhere(np.isnan(PC_wnans))
-            ## get PC percs with original (to avoid nan error and following adult paper methods)
-            PC_percs = np.asarray([stats.percentileofscore(PC_nonans, i) for i in PC_nonans])
-            ## Censor out any low degree (<25th perc) nodes
-            degs = bct.degrees_und(pc_upper_mat)
-            low = np.percentile(degs, 25)
-            deg_mult = np.where(degs < low, 0, 1)
-            deg_cens_PC_percs = PC_percs * deg_mult
-            ## convert to nans for nanmean function later
-            deg_cens_PC_percs[deg_cens_PC_percs == 0] = np.float64('nan')
-            # put back nans from PC step (again for nanmean step)
-            cens_PC_perc_wnan = deg_cens_PC_percs.copy() # making a copy to be safe/no overwrite
-            cens_PC_perc_wnan[PC_nan_mask] = np.float64('nan')
-            # Save as text file for later
-            pc_perc_path = os.path.join(pc_outputs_dir,f'{subid}_{thr}_CENS_PC_PERC.txt')
-            f = open(pc_perc_path, 'w')
-            for cpc_perc in cens_PC_perc_wnan:
-                cpc_perc_line = (str(cpc_perc),'\n')
-                f.write(' '.join(cpc_perc_line))
-            f.close()  
-        logger.debug(f'   -Complete: Degree censor & PC cals/perc per thresh')
-
-        ## Now get the average across percentiles using nanmean
-        logger.debug(f'  -Averaging PC percentiles')
-        all_thresh_PCs_list = []
-        for thr in threshold_list:
-            cpc_perc_path = os.path.join(pc_outputs_dir,f'{subid}_{thr}_CENS_PC_PERC.txt')
-            cpc_perc_vect = np.loadtxt(cpc_perc_path)
-            all_thresh_PCs_list.append(cpc_perc_vect.tolist())
-        ## convert to numpy array & average
-        allPC_percs_wnans = np.array(all_thresh_PCs_list)
-        avg_PC_perc = np.nanmean(allPC_percs_wnans, axis=0)
-        avg_PC_perc = np.nan_to_num(avg_PC_perc) 
-        ## Save subject's avg pc percentage vect as .txt for later
-        avg_pc_dir = os.path.join(args.outdir,'final_avg_pc_percs')
-        avg_pc_path = os.path.join(avg_pc_dir,f'{subid}_FINAL_AVG_PC_PERCENTAGE.txt')
-        f = open(avg_pc_path, 'w')
-        for av in avg_PC_perc :
-            av_line = (str(av),'\n')
-            f.write(' '.join(av_line))
-        f.close()
-
-        logger.debug(f'   AVG degree censored PC file calculated and saved.')
-
-    def label_hubs(subid):
-        # Step 10: Label parcels above 80 as a hub
-        # Load average, degree censored, PC percentile file:
-        pc_percs_dir = os.path.join(args.outdir,'final_avg_pc_percs')
-        avg_perc_path = os.path.join(pc_percs_dir,f'{subid}_FINAL_AVG_PC_PERCENTAGE.txt')
-        avg_vect = np.loadtxt(avg_perc_path)
-        ## added per EG - 5.3.21 - get percentile rank of avg perc values
-        final_avg_perc_vect = np.asarray([stats.percentileofscore(avg_vect, i) for i in avg_vect])
-        cens_avg_vect = np.where(final_avg_perc_vect < 80, 0, final_avg_perc_vect)
-        hub_indices = np.asarray(np.nonzero(cens_avg_vect)[0])
-        ## add 1 to adjust for python 0 indexing to get parcel # of hub(s)
-        hub_indices = hub_indices + 1
-        hub_list = hub_indices.tolist()
-        logger.debug(f'  -Number of hubs found: {hub_indices.shape[0]}')
-        ## SAVE HUB indices for density map creation
-        hub_indices_dir = os.path.join(args.outdir,'final_hub_indices')
-        hub_indices_path = os.path.join(hub_indices_dir,f'{subid}_HUB_INDICES.txt')
-        f = open(hub_indices_path, 'w')
-        for hi in hub_list:
-            hi_line = (str(hi),'\n')
-            f.write(' '.join(hi_line))
-        f.close()
-        logger.debug('   -Hub index text file saved')
-
-        ### Make basic dlabel of hubs
-        logger.debug('  -BONUS: Auto-create hub dlabel.nii file')
-        ## Load template dlabel
-        img = nb.load(gordon_parcel_path)
-        image_data = img.get_fdata()
-        image_data = np.asarray(image_data,dtype=np.int16)  # here I retain the shape of the dataobj
-        ## get axes info
-        axes = [nb.cifti2.cifti2_axes.from_index_mapping(mim) for mim in img.header.matrix]
-        ## load my example header and get the original LabelAxis as a dict....
-        cifti_header = img.header
-        namedmp = cifti_header.get_axis(0)
-        brainmodel = cifti_header.get_axis(1)
-        label_dict = namedmp.label[0]
-        ## edit dict to highlight hubs
-        # iterate over parcels in label dict. If not a hub = half transparent. If hub, change color and label name. 
-        hub_number = 1
-        for lab in label_dict:
-            if lab in hub_list:
-                # label and color as a hub
-                logger.debug(f'   -found hub {hub_number}')
-                label_dict[lab] = (f'    -Subject_Hub_{hub_number}', overlay_color) 
-                hub_number = hub_number + 1
-            else:
-                if lab == 0:
-                    pass
-                else:
-                    parc_name = label_dict[lab][0]
-                    tup_list = list(label_dict[lab][1])
-                    tup_list[-1] = 0
-                    color_tup = tuple(tup_list)
-                    label_dict[lab] = (parc_name, color_tup)
-        ## make the new dict a LabelAxis object
-        updated_hub_axis = nb.cifti2.LabelAxis([""], label_dict)
-        ## finally, use new label axis and original brain model and write the new file out
-        dlabel_output_dir = os.path.join(args.outdir,'final_hubs_dlabels')
-        new_header = nb.cifti2.cifti2_axes.to_header([updated_hub_axis, brainmodel])
-        new_cifti = nb.cifti2.Cifti2Image(image_data, new_header)
-        dlabel_path = os.path.join(dlabel_output_dir,f'{subid}.dlabel.nii')
-        new_cifti.to_filename(dlabel_path)
-        logger.debug(f'  -Hub surface dlabel.nii file made: {dlabel_path}')
-
     ### SCRIPT ENTRY ###
-    # Iterate over participant data entries 
-    for entry in input_data:
-        subid = entry.split(' ')[0]
-        ts_path = entry.split(' ')[1]
-        preprocd_ts = np.loadtxt(ts_path)
-        logger.debug(f'{subid}')
-        # I. Create z transformed corr mat
-        logger.debug(f' -Creating zmat and distance censoring')
-        ztrans_mat = make_zmat(preprocd_ts)
-        # II. Distance censor zmat
-        dist_censored_zmat = dist_censor(ztrans_mat)
-        # III. Run infomap
-        logger.debug(f' -Running infomap at all thresholds')
-        run_infomap(subid, dist_censored_zmat)
-        # IV. Calculate PC, get percs, censor, avg percs, save file
-        logger.debug(f' -Running Participation Coefficient steps')
-        run_pc_steps(subid)
-        # V. Identify/Label hubs, make indices file, create hubs dlabel file
-        logger.debug(f' -Identifying hub parcels')
-        label_hubs(subid)
+    # Load distance censoring mask once (same for every participant)
+    mult_mat = np.genfromtxt(mult_mat_path, delimiter=',')
+    # Random infomap seeds for each participant & threshold (drawn here so they do not depend on -jobs)
+    subject_seeds = [[random.randint(1,9999) for thresh in threshold_list] for entry in input_data]
+    # Iterate over participant data entries (independent, so they can run across -jobs worker processes)
+    if args.jobs == 1:
+        for entry,infomap_seeds in zip(input_data,subject_seeds):
+            process_subject(entry, infomap_seeds, args, overlay_color, mult_mat)
+    else:
+        # workers memory map one .npy copy of the mask (shared OS page cache) instead of each task pickling it
+        with tempfile.TemporaryDirectory() as shared_dir:
+            mult_mat_npy = os.path.join(shared_dir,'mult_mat.npy')
+            np.save(mult_mat_npy, mult_mat)
+            with ProcessPoolExecutor(max_workers=args.jobs, initializer=init_worker,
+                                     initargs=(mult_mat_npy,)) as executor:
+                sub_futures = [executor.submit(process_subject, entry, infomap_seeds, args, overlay_color)
+                               for entry,infomap_seeds in zip(input_data,subject_seeds)]
+                for sub_future in as_completed(sub_futures):
+                    logger.debug(f'{sub_future.result()} - all steps done')
     # VI. Clean temp files
     if args.nocleanup == True:
         logger.debug(f' -Temp/working files RETAINED. All steps done.')